@@ -46,6 +46,10 @@ p.add_argument('-p', '--pathways_file',
                      0B.preprocess_plier_data.ipynb for file format')
 p.add_argument('-s', '--shuffle', action='store_true',
                help='randomize gene expression data for negative control')
+p.add_argument('--use_cache', action='store_true',
+               help='reuse saved PCA/NMF fits if the same data/seed was run\
+                     before (fits are saved to data_dir/sklearn_output, one\
+                     file per seed, and are not cleaned up)')
 p.add_argument('-v', '--verbose', action='store_true')
 args = p.parse_args()
 
@@ -104,7 +108,8 @@ for ix, seed in enumerate(random_seeds, 1):
         logging.debug('-- Fitting pca model for random seed {} of {}'.format(
                       ix, len(random_seeds)))
         dm.pca(n_components=args.num_components,
-               transform_test_df=True)
+               transform_test_df=True,
+               use_cache=args.use_cache)
     if 'ica' in algs_to_run:
         logging.debug('-- Fitting ica model for random seed {} of {}'.format(
                       ix, len(random_seeds)))
@@ -116,7 +121,8 @@ for ix, seed in enumerate(random_seeds, 1):
                       ix, len(random_seeds)))
         dm.nmf(n_components=args.num_components,
                transform_test_df=True,
-               seed=seed)
+               seed=seed,
+               use_cache=args.use_cache)
     if 'plier' in algs_to_run:
         logging.debug('-- Fitting PLIER model for random seed {} of {}'.format(
                       ix, len(random_seeds)))
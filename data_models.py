@@ -4,14 +4,115 @@ https://github.com/greenelab/tybalt/blob/master/tybalt/data_models.py
 
 """
 import os
+import hashlib
+import tempfile
+import joblib
 import numpy as np
 import pandas as pd
-from scipy.stats.mstats import zscore
+import sklearn
+from joblib import Parallel, delayed
 from sklearn import decomposition
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
+from sklearn.preprocessing import MinMaxScaler
+from threadpoolctl import threadpool_limits
 
 import config as cfg
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+def _read_expression_tsv(filename, float_columns=None):
+    """Read a (samples x genes) expression TSV directly into float32.
+
+    Reading the header first lets the C parser convert the expression
+    columns straight to float32, rather than inferring float64 columns and
+    downcasting them afterward. If float_columns (integer positions) is
+    given, only those columns are read as float32, and the types of the
+    other columns are inferred as usual.
+    """
+    header = pd.read_csv(filename, sep='\t', index_col=0, nrows=0)
+    columns = header.columns
+    if float_columns:
+        columns = columns[np.asarray(float_columns)]
+    dtypes = {col: np.float32 for col in columns}
+    return pd.read_csv(filename, sep='\t', index_col=0, dtype=dtypes,
+                       engine='c')
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def _bce_kernel(x, z, p, epsilon):
+        """Single-pass, multithreaded version of the cross entropy computed by
+        DataModel._approx_keras_binary_cross_entropy (see there for details).
+        """
+        n_rows, n_cols = x.shape
+        row_means = np.empty(n_rows)
+        for i in prange(n_rows):
+            total = 0.0
+            for j in range(n_cols):
+                x_ij = min(max(x[i, j], epsilon), 1 - epsilon)
+                total -= (z[i, j] * np.log(x_ij) +
+                          (1 - z[i, j]) * np.log1p(-x_ij))
+            row_means[i] = total / n_cols
+        return p * row_means.mean()
+else:
+    _bce_kernel = None
+
+
+class _ZScoreScaler():
+    """Lightweight replacement for sklearn's StandardScaler on dense data.
+
+    Skips StandardScaler's input validation and computes the column
+    statistics with float64 accumulators, centering and scaling the data in
+    place unless copy is True. Exposes the same mean_, var_ and scale_
+    attributes and transform/inverse_transform methods, so it can be used
+    interchangeably with StandardScaler.
+    """
+    def __init__(self, copy=True):
+        self.copy = copy
+
+    def _as_float_array(self, X, copy=None):
+        X = np.array(X, copy=(self.copy if copy is None else copy))
+        if not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(np.float64)
+        return X
+
+    def _set_scale(self):
+        # features with zero variance are left unscaled, as in sklearn
+        self.scale_ = np.sqrt(self.var_)
+        self.scale_[self.scale_ == 0.0] = 1.0
+
+    def fit(self, X):
+        X = np.asarray(X)
+        self.mean_ = X.mean(axis=0, dtype=np.float64)
+        self.var_ = X.var(axis=0, dtype=np.float64)
+        self._set_scale()
+        return self
+
+    def fit_transform(self, X):
+        X = self._as_float_array(X)
+        self.mean_ = X.mean(axis=0, dtype=np.float64)
+        X -= self.mean_
+        # X is centered now, so the variance is just the mean of squares
+        self.var_ = np.einsum('ij,ij->j', X, X, dtype=np.float64) / len(X)
+        self._set_scale()
+        X /= self.scale_
+        return X
+
+    def transform(self, X, copy=None):
+        X = self._as_float_array(X, copy=copy)
+        X -= self.mean_
+        X /= self.scale_
+        return X
+
+    def inverse_transform(self, X, copy=None):
+        X = self._as_float_array(X, copy=copy)
+        X *= self.scale_
+        X += self.mean_
+        return X
+
+
 class DataModel():
     """
     Methods for loading and compressing input data
@@ -30,7 +131,9 @@ class DataModel():
         Arguments:
         filename - if provided, load gene expression data into object
         df - dataframe of preloaded gene expression data
-        select_columns - the columns of the dataframe to use
+        select_columns - the columns of the dataframe to use (integer
+        positions, kept in the given order); all remaining columns are stored
+        in other_df, in their original order
         gene_modules - a list of gene module assignments for each gene (for use
         with the simulated data or when ground truth gene modules are known)
         test_filename - if provided, loads testing dataset into object
@@ -41,13 +144,25 @@ class DataModel():
         if filename is None:
             self.df = df
         else:
-            self.df = pd.read_table(self.filename, index_col=0)
+            self.df = _read_expression_tsv(self.filename,
+                                           float_columns=select_columns)
+
+        # Load test set gene expression data if applicable
+        self.test_filename = test_filename
+        self.test_df = test_df
+
+        if test_filename is not None and test_df is None:
+            self.test_df = _read_expression_tsv(self.test_filename,
+                                                float_columns=select_columns)
 
         if select_columns:
-            subset_df = self.df.iloc[:, select_columns]
-            other_columns = range(max(select_columns) + 1, self.df.shape[1])
-            self.other_df = self.df.iloc[:, other_columns]
-            self.df = subset_df
+            # the selected columns keep the order (and any duplicates) given
+            # in select_columns; a boolean mask picks out every other column,
+            # in file order, without building the complement in Python
+            mask = np.zeros(self.df.shape[1], dtype=bool)
+            mask[np.asarray(select_columns)] = True
+            self.other_df = self.df.iloc[:, ~mask]
+            self.df = self.df.iloc[:, select_columns]
             if self.test_df is not None:
                 self.test_df = self.test_df.iloc[:, select_columns]
 
@@ -57,41 +172,55 @@ class DataModel():
 
         self.num_samples, self.num_genes = self.df.shape
 
-        # Load test set gene expression data if applicable
-        self.test_filename = test_filename
-        self.test_df = test_df
-
         if test_filename is not None and test_df is None:
-            self.test_df = pd.read_table(self.test_filename, index_col=0)
             self.num_test_samples, self.num_test_genes = self.test_df.shape
 
             assert_ = 'train and test sets must have same number of genes'
             assert self.num_genes == self.num_test_genes, assert_
 
+        # single precision is plenty for expression data, and halves the
+        # memory traffic for scaling and the decompositions below
+        self.df = self.df.astype(np.float32, copy=False)
+        if self.test_df is not None:
+            self.test_df = self.test_df.astype(np.float32, copy=False)
+
 
     def transform(self, how):
         self.transformation = how
         if how == 'zscore':
-            self.transform_fit = StandardScaler().fit(self.df)
+            scaler = _ZScoreScaler
         elif how == 'zeroone':
-            self.transform_fit = MinMaxScaler().fit(self.df)
+            scaler = MinMaxScaler
         else:
             raise ValueError('how must be either "zscore" or "zeroone".')
 
-        self.df = pd.DataFrame(self.transform_fit.transform(self.df),
-                               index=self.df.index,
-                               columns=self.df.columns)
+        # dataframes that were read from disk here aren't shared with the
+        # caller, so it's safe to scale their values in place
+        self.transform_fit = scaler(copy=(self.filename is None))
+        index, columns = self.df.index, self.df.columns
+        self.df = pd.DataFrame(
+                self.transform_fit.fit_transform(self.df.to_numpy(copy=False)),
+                index=index, columns=columns, copy=False)
 
         if self.test_df is not None:
-            if how == 'zscore':
-                self.transform_test_fit = StandardScaler().fit(self.test_df)
-            elif how == 'zeroone':
-                self.transform_test_fit = MinMaxScaler().fit(self.test_df)
-
-            test_transform = self.transform_test_fit.transform(self.test_df)
-            self.test_df = pd.DataFrame(test_transform,
-                                        index=self.test_df.index,
-                                        columns=self.test_df.columns)
+            # the test set must be scaled using the statistics of the
+            # training set, otherwise information leaks from the test set
+            # into the transformed data
+            #
+            # (the train scaler may work in place, so copy the test data if
+            # it belongs to the caller)
+            self.transform_test_fit = self.transform_fit
+            index, columns = self.test_df.index, self.test_df.columns
+            test_values = self.test_df.to_numpy(
+                    copy=(self.test_filename is None and
+                          not self.transform_fit.copy))
+            test_values = self.transform_fit.transform(test_values)
+            if how == 'zeroone':
+                # test values outside the range of the training set would
+                # fall outside [0, 1], and NMF can't handle negative values
+                np.clip(test_values, 0, 1, out=test_values)
+            self.test_df = pd.DataFrame(test_values, index=index,
+                                        columns=columns, copy=False)
 
 
     @classmethod
@@ -99,18 +228,28 @@ class DataModel():
         return ['pca', 'ica', 'nmf', 'plier']
 
 
-    def pca(self, n_components, transform_df=False, transform_test_df=False):
-        self.pca_fit = decomposition.PCA(n_components=n_components)
-        self.pca_df = self.pca_fit.fit_transform(self.df)
-        colnames = ['pca_{}'.format(x) for x in range(0, n_components)]
+    def pca(self, n_components, transform_df=False, transform_test_df=False,
+            seed=1, svd_solver=None, use_cache=False):
+        if svd_solver is None:
+            # a truncated randomized SVD is much cheaper than the full SVD
+            # when only a few components of a wide matrix are needed
+            if n_components < 0.8 * min(self.df.shape):
+                svd_solver = 'randomized'
+            else:
+                svd_solver = 'full'
+        self.pca_fit = decomposition.PCA(n_components=n_components,
+                                         svd_solver=svd_solver,
+                                         random_state=seed)
+        self.pca_fit, self.pca_df = self._cached_fit_transform(
+                'pca', self.pca_fit, use_cache=use_cache)
+        colnames = pd.Index(['pca_{}'.format(x) for x in range(n_components)])
         self.pca_df = pd.DataFrame(self.pca_df, index=self.df.index,
                                    columns=colnames)
         self.pca_weights = pd.DataFrame(self.pca_fit.components_,
                                         columns=self.df.columns,
                                         index=colnames)
         if transform_df:
-            out_df = self.pca_fit.transform(self.df)
-            return out_df
+            return self.pca_df.values
 
         if transform_test_df:
             self.pca_test_df = self.pca_fit.transform(self.test_df)
@@ -121,7 +260,7 @@ class DataModel():
         self.ica_fit = decomposition.FastICA(n_components=n_components,
                                              random_state=seed)
         self.ica_df = self.ica_fit.fit_transform(self.df)
-        colnames = ['ica_{}'.format(x) for x in range(0, n_components)]
+        colnames = pd.Index(['ica_{}'.format(x) for x in range(n_components)])
         self.ica_df = pd.DataFrame(self.ica_df, index=self.df.index,
                                     columns=colnames)
         self.ica_weights = pd.DataFrame(self.ica_fit.components_,
@@ -136,11 +275,13 @@ class DataModel():
 
 
     def nmf(self, n_components, transform_df=False, transform_test_df=False,
-            seed=1, init='nndsvdar', tol=5e-3):
-        self.nmf_fit = decomposition.NMF(n_components=n_components, init=init,
-                                         tol=tol, random_state=seed)
-        self.nmf_df = self.nmf_fit.fit_transform(self.df)
-        colnames = ['nmf_{}'.format(x) for x in range(n_components)]
+            seed=1, init='nndsvdar', tol=5e-3, use_cache=False):
+        self.nmf_fit = decomposition.NMF(n_components=n_components,
+                                         init=init, tol=tol,
+                                         random_state=seed)
+        self.nmf_fit, self.nmf_df = self._cached_fit_transform(
+                'nmf', self.nmf_fit, use_cache=use_cache)
+        colnames = pd.Index(['nmf_{}'.format(x) for x in range(n_components)])
 
         self.nmf_df = pd.DataFrame(self.nmf_df, index=self.df.index,
                                    columns=colnames)
@@ -148,13 +289,64 @@ class DataModel():
                                         columns=self.df.columns,
                                         index=colnames)
         if transform_df:
-            out_df = self.nmf_fit.transform(self.df)
-            return out_df
+            return self.nmf_df.values
 
         if transform_test_df:
             self.nmf_test_df = self.nmf_fit.transform(self.test_df)
 
 
+    def _cached_fit_transform(self, algorithm, model, use_cache=False):
+        """Fit a sklearn model to the training data, optionally reusing a
+        saved fit if an identical model was already fit to identical data.
+
+        If use_cache is True, fits are saved in cfg.data_dir/sklearn_output,
+        keyed on a hash of the training data (its values, shape and dtype),
+        the model's parameters (e.g. n_components, seed) and the scikit-learn
+        version. Nothing removes old fits, so every new seed or dataset adds
+        another file to that directory; this is meant for re-running the same
+        fits (e.g. repeating a sweep), and is off by default.
+
+        Returns the fitted model and the transformed training data.
+        """
+        if not use_cache:
+            return model, model.fit_transform(self.df)
+
+        # hash the existing buffer rather than making a C-ordered copy (a
+        # single-dtype frame's values are usually Fortran-ordered)
+        values = self.df.to_numpy(copy=False)
+        if values.flags.f_contiguous:
+            data, layout = values.T, 'F'
+        else:
+            data, layout = np.ascontiguousarray(values), 'C'
+        data_hash = hashlib.blake2b(data.view(np.uint8), digest_size=8)
+        data_hash.update(str((values.shape, values.dtype.str, layout)).encode())
+        data_hash.update(str(sorted(model.get_params().items())).encode())
+        data_hash.update(sklearn.__version__.encode())
+
+        # exist_ok, since fit_all may run several fits at once
+        cache_dir = os.path.join(cfg.data_dir, 'sklearn_output')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, '{}_{}.joblib'.format(
+                                    algorithm, data_hash.hexdigest()))
+
+        if os.path.exists(cache_file):
+            return joblib.load(cache_file)
+
+        transformed = model.fit_transform(self.df)
+        # write to a temporary file and move it into place, so concurrent
+        # fits never load a partially written file
+        tf = tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp',
+                                         delete=False)
+        tf.close()
+        try:
+            joblib.dump((model, transformed), tf.name, compress=3)
+            os.replace(tf.name, cache_file)
+        except BaseException:
+            os.remove(tf.name)
+            raise
+        return model, transformed
+
+
     def plier(self, n_components, pathways_file, transform_df=False,
               transform_test_df=False, shuffled=False, seed=1,
               verbose=False, skip_cache=False):
@@ -182,10 +374,18 @@ class DataModel():
             #
             # Thus, open the file with delete=False here, then clean up the
             # temporary file manually after PLIER is finished running.
-            tf = tempfile.NamedTemporaryFile(mode='w', delete=False)
+            #
+            # The data is passed to R as a feather file, which avoids
+            # formatting every value as text and parsing it again in R.
+            # Feather doesn't store row names, so the sample IDs are written
+            # as the first column.
+            tf = tempfile.NamedTemporaryFile(suffix='.feather', delete=False)
             expression_filename = tf.name
-            self.df.to_csv(tf, sep='\t')
             tf.close()
+            feather_df = self.df.reset_index()
+            feather_df.columns = feather_df.columns.astype(str)
+            feather_df.to_feather(expression_filename)
+            del feather_df
 
             args = [
                 'Rscript',
@@ -215,6 +415,7 @@ class DataModel():
         # - plier_weights = PLIER Z.T, has shape (n_components, n_features)
         self.plier_df = pd.read_csv(output_weights, sep='\t').T
         self.plier_weights = pd.read_csv(output_data, sep='\t').T
+        self._plier_gene_cols = self.plier_weights.columns.astype('str')
         plier_l2 = np.loadtxt(output_l2)
 
         if skip_cache:
@@ -227,19 +428,65 @@ class DataModel():
             os.remove(output_weights)
             os.remove(output_l2)
 
-        # Filter to intersection of expression genes and genes in pathway
-        # dataset (PLIER does this internally, but we also need to do it here
-        # for the downstream analysis)
-        test_df_filtered = self.test_df[self.plier_weights.columns.astype('str')]
-
         if transform_df:
             return self.plier_df
         if transform_test_df:
+            # Filter to intersection of expression genes and genes in pathway
+            # dataset (PLIER does this internally, but we also need to do it
+            # here for the downstream analysis)
+            test_df_filtered = self.test_df.loc[:, self._plier_gene_cols]
             self.plier_test_df = self._plier_on_test_data(test_df_filtered,
                                                           self.plier_weights,
                                                           plier_l2)
 
 
+    def fit_all(self, n_components, algorithms=None, pathways_file=None,
+                transform_test_df=False, seed=1, use_cache=False):
+        """Fit several compression algorithms concurrently.
+
+        The fits are independent of one another and spend nearly all of their
+        time in BLAS/LAPACK calls (or, for PLIER, in an R subprocess), which
+        release the GIL, so they can run on threads sharing the same data.
+
+        Arguments:
+        n_components - latent space dimension for each algorithm
+        algorithms - list of algorithms to fit (default: all algorithms in
+                     list_algorithms(), skipping PLIER if no pathways_file
+                     is provided)
+        pathways_file - pathways file to use for PLIER
+        transform_test_df - if True, also transform the test set
+        seed - random seed passed to each algorithm
+        use_cache - if True, reuse/save PCA and NMF fits (see
+                    _cached_fit_transform)
+        """
+        if algorithms is None:
+            algorithms = [alg for alg in self.list_algorithms()
+                              if alg != 'plier' or pathways_file is not None]
+
+        jobs = []
+        for algorithm in algorithms:
+            if algorithm not in self.list_algorithms():
+                raise ValueError('unknown algorithm: {}'.format(algorithm))
+            kwargs = {'transform_test_df': transform_test_df, 'seed': seed}
+            if algorithm in ['pca', 'nmf']:
+                kwargs['use_cache'] = use_cache
+            if algorithm == 'plier':
+                if pathways_file is None:
+                    raise ValueError('pathways_file is required for PLIER')
+                kwargs['pathways_file'] = pathways_file
+            jobs.append(delayed(getattr(self, algorithm))(n_components,
+                                                          **kwargs))
+
+        if not jobs:
+            return
+
+        # split the BLAS threads between the concurrent fits, to avoid
+        # oversubscribing the available cores
+        with threadpool_limits(
+                limits=max(1, (os.cpu_count() or 1) // len(jobs))):
+            Parallel(n_jobs=len(jobs), backend='threading')(jobs)
+
+
     def write_models(self, output_dir, file_suffix, test_set=False):
         """Write models (z matrices) to the given file.
 
@@ -307,46 +554,52 @@ class DataModel():
         else:
             input_df = self.df
 
-        all_reconstruction = {}
-        reconstruct_mat = {}
-
-        def add_method_reconstruction(method_df, method_test_df,
-                                      method_name, method_object,
-                                      num_genes=self.num_genes,
-                                      is_plier=False):
-            if test_set:
-                method_df = method_test_df
-            if is_plier:
-                method_reconstruct = np.dot(method_df, self.plier_weights)
-            else:
-                method_reconstruct = method_object.inverse_transform(method_df)
-            method_recon = self._approx_keras_binary_cross_entropy(
-                method_reconstruct, input_df, num_genes)
-            all_reconstruction[method_name] = [method_recon]
-            reconstruct_mat[method_name] = pd.DataFrame(method_reconstruct,
-                                                        index=input_df.index,
-                                                        columns=input_df.columns)
-            return all_reconstruction, reconstruct_mat
-
+        # all of the models here reconstruct the input linearly, so each
+        # reconstruction is a single GEMM with the model's components (plus the
+        # centering offset for PCA/ICA), without the input validation and
+        # extra copies of inverse_transform
+        #
+        # (name, components, offset, input dataframe to compare against)
+        models = []
         if hasattr(self, 'pca_df'):
-            all_reconstruction, reconstruct_mat = add_method_reconstruction(
-                    self.pca_df, self.pca_test_df, 'pca', self.pca_fit)
-
+            models.append(('pca', self.pca_fit.components_,
+                           self.pca_fit.mean_, input_df))
         if hasattr(self, 'ica_df'):
-            all_reconstruction, reconstruct_mat = add_method_reconstruction(
-                    self.ica_df, self.ica_test_df, 'ica', self.ica_fit)
-
+            ica_mean = self.ica_fit.mean_ if self.ica_fit.whiten else None
+            models.append(('ica', self.ica_fit.mixing_.T, ica_mean, input_df))
         if hasattr(self, 'nmf_df'):
-            all_reconstruction, reconstruct_mat = add_method_reconstruction(
-                    self.nmf_df, self.nmf_test_df, 'nmf', self.nmf_fit)
-
+            models.append(('nmf', self.nmf_fit.components_, None, input_df))
         if hasattr(self, 'plier_df'):
             # have to do filtering to genes present in pathway dataset here too
-            plier_input_df = input_df[self.plier_weights.columns.astype('str')]
-            num_genes = len(self.plier_weights.columns)
-            all_reconstruction, reconstruct_mat = add_method_reconstruction(
-                    self.plier_df, self.plier_test_df, 'plier', self.plier_fit,
-                    num_genes, is_plier=True)
+            plier_input_df = input_df.loc[:, self._plier_gene_cols]
+            models.append(('plier', self.plier_weights.values, None,
+                           plier_input_df))
+
+        all_reconstruction = {}
+        reconstruct_mat = {}
+        input_values = input_df.to_numpy(copy=False)
+        for method_name, components, mean, method_input_df in models:
+            if test_set:
+                method_z = getattr(self, '{}_test_df'.format(method_name))
+            else:
+                method_z = getattr(self, '{}_df'.format(method_name))
+            method_reconstruct = np.dot(np.asarray(method_z), components)
+            if mean is not None:
+                method_reconstruct += mean
+
+            if method_input_df is input_df:
+                method_input = input_values
+            else:
+                method_input = method_input_df.to_numpy(copy=False)
+            all_reconstruction[method_name] = [
+                    self._approx_keras_binary_cross_entropy(
+                        method_reconstruct, method_input,
+                        method_input.shape[1])]
+            reconstruct_mat[method_name] = pd.DataFrame(
+                    method_reconstruct,
+                    index=method_input_df.index,
+                    columns=method_input_df.columns,
+                    copy=False)
 
         return pd.DataFrame(all_reconstruction), reconstruct_mat
 
@@ -384,10 +637,14 @@ class DataModel():
         """
         from sklearn.linear_model import ridge_regression
         from scipy.stats import zscore
+        # there are only n_components coefficients per sample, so solving
+        # the (n_components x n_components) normal equations directly is
+        # much cheaper than taking an SVD of the (n_features x n_components)
+        # weight matrix
         return ridge_regression(weights.T,
-                                X.apply(zscore).T,
+                                zscore(np.asarray(X), axis=0).T,
                                 lambda_2,
-                                solver='svd')
+                                solver='cholesky')
 
 
     def _approx_keras_binary_cross_entropy(self, x, z, p, epsilon=1e-07):
@@ -420,17 +677,31 @@ class DataModel():
             Approximation to the cross-entropy between x and z.
 
         """
-        # Ensure numpy arrays
-        x = np.array(x)
-        z = np.array(z)
+        # Use the compiled kernel if numba is available; it does the clipping
+        # and reduction in one pass without any temporary arrays
+        if _bce_kernel is not None:
+            x = np.ascontiguousarray(x)
+            z = np.ascontiguousarray(z, dtype=x.dtype)
+            return _bce_kernel(x, z, p, epsilon)
+
+        # Ensure numpy arrays: x is clipped and transformed in place below, so
+        # it needs its own copy, but z is only read
+        x = np.array(x, copy=True)
+        z = np.asarray(z, dtype=x.dtype)
 
         # Add clip to value
-        x[x < epsilon] = epsilon
-        x[x > (1 - epsilon)] = (1 - epsilon)
-
-        # Perform logit
-        x = np.log(x / (1 - x))
+        np.clip(x, epsilon, 1 - epsilon, out=x)
+
+        # With l = logit(x), log(1 + exp(l)) = -log(1 - x), so the
+        # sigmoid cross entropy -l * z + log(1 + exp(l)) simplifies to
+        # -(z * log(x) + (1 - z) * log(1 - x)). This is exact for any z, never
+        # overflows, and can be computed in place with one temporary.
+        log_1mx = np.log1p(-x)
+        np.log(x, out=x)
+        x -= log_1mx
+        x *= z
+        x += log_1mx
 
         # Return approximate binary cross entropy
-        return np.mean(p * np.mean(- x * z + np.log(1 + np.exp(x)), axis=-1))
+        return np.mean(p * np.mean(-x, axis=-1))
 
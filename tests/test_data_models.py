@@ -0,0 +1,127 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+import sys; sys.path.append('.')
+import config as cfg
+import data_models
+from data_models import DataModel, _ZScoreScaler
+from sklearn.preprocessing import StandardScaler
+
+@pytest.fixture
+def bce_data():
+    np.random.seed(cfg.default_seed)
+    n, p = 15, 20
+    # include values outside [epsilon, 1 - epsilon] so clipping is exercised
+    x = np.random.uniform(size=(n, p))
+    x[0, :5] = [0.0, 1.0, 1e-9, 1 - 1e-9, 0.5]
+    z = np.random.uniform(size=(n, p))
+    dm = DataModel(df=pd.DataFrame(z))
+    return dm, x, z, p
+
+
+def _baseline_bce(x, z, p, epsilon=1e-07):
+    """Original (logit-based) cross entropy computation."""
+    x = np.array(x)
+    z = np.array(z)
+    x[x < epsilon] = epsilon
+    x[x > (1 - epsilon)] = (1 - epsilon)
+    x = np.log(x / (1 - x))
+    return np.mean(p * np.mean(- x * z + np.log(1 + np.exp(x)), axis=-1))
+
+
+def test_bce_numpy(bce_data, monkeypatch):
+    """Test NumPy cross entropy against the original logit formula."""
+    dm, x, z, p = bce_data
+    monkeypatch.setattr(data_models, '_bce_kernel', None)
+    x_orig = x.copy()
+    result = dm._approx_keras_binary_cross_entropy(x, z, p)
+    assert np.isclose(result, _baseline_bce(x, z, p), rtol=1e-6)
+    # input shouldn't be modified
+    assert np.array_equal(x, x_orig)
+
+
+def test_bce_kernel(bce_data, monkeypatch):
+    """Test numba cross entropy against NumPy and the original formula."""
+    dm, x, z, p = bce_data
+    if data_models._bce_kernel is None:
+        pytest.skip('numba not installed')
+    kernel_result = dm._approx_keras_binary_cross_entropy(x, z, p)
+    monkeypatch.setattr(data_models, '_bce_kernel', None)
+    numpy_result = dm._approx_keras_binary_cross_entropy(x, z, p)
+    assert np.isclose(kernel_result, numpy_result, rtol=1e-6)
+    assert np.isclose(kernel_result, _baseline_bce(x, z, p), rtol=1e-6)
+
+
+@pytest.fixture
+def zscore_data():
+    np.random.seed(cfg.default_seed)
+    X = np.random.normal(loc=3.0, scale=2.0, size=(15, 20)).astype(np.float32)
+    X_test = np.random.normal(loc=3.0, scale=2.0, size=(5, 20)).astype(np.float32)
+    # zero-variance column, which should be centered but not scaled
+    X[:, 0] = 1.5
+    return X, X_test
+
+
+@pytest.mark.parametrize('copy', [True, False])
+def test_zscore_scaler(zscore_data, copy):
+    """Test z-scoring against sklearn's StandardScaler."""
+    X, X_test = zscore_data
+    sk_scaler = StandardScaler()
+    sk_train = sk_scaler.fit_transform(X)
+    sk_test = sk_scaler.transform(X_test)
+
+    X_in = X.copy()
+    scaler = _ZScoreScaler(copy=copy)
+    train = scaler.fit_transform(X_in)
+    test = scaler.transform(X_test, copy=True)
+
+    assert train.dtype == np.float32
+    assert np.allclose(train, sk_train, atol=1e-5)
+    assert np.allclose(test, sk_test, atol=1e-5)
+    assert np.allclose(scaler.mean_, sk_scaler.mean_)
+    assert np.allclose(scaler.var_, sk_scaler.var_)
+    assert np.allclose(scaler.scale_, sk_scaler.scale_)
+    assert np.allclose(scaler.inverse_transform(train, copy=True), X,
+                       atol=1e-5)
+    # the input should only be overwritten when copy is False
+    if copy:
+        assert np.array_equal(X_in, X)
+    else:
+        assert train is X_in
+
+    # fit() should give the same statistics as fit_transform()
+    fit_scaler = _ZScoreScaler().fit(X)
+    assert np.allclose(fit_scaler.mean_, scaler.mean_)
+    assert np.allclose(fit_scaler.var_, scaler.var_)
+
+
+def test_zscore_transform(zscore_data):
+    """Test DataModel z-scoring against StandardScaler fit on the train set."""
+    X, X_test = zscore_data
+    X_orig, X_test_orig = X.copy(), X_test.copy()
+    dm = DataModel(df=pd.DataFrame(X), test_df=pd.DataFrame(X_test))
+    dm.transform(how='zscore')
+    sk_scaler = StandardScaler().fit(X)
+    assert np.allclose(dm.df.values, sk_scaler.transform(X), atol=1e-5)
+    assert np.allclose(dm.test_df.values, sk_scaler.transform(X_test),
+                       atol=1e-5)
+    # dataframes passed in by the caller shouldn't be scaled in place
+    assert np.array_equal(X, X_orig)
+    assert np.array_equal(X_test, X_test_orig)
+
+
+def test_zeroone_transform():
+    """Test that zero-one scaled test data is clipped to the train range."""
+    np.random.seed(cfg.default_seed)
+    X = np.random.uniform(size=(15, 20))
+    # test values both below and above the range of the training data
+    X_test = np.random.uniform(low=-1.0, high=2.0, size=(5, 20))
+    dm = DataModel(df=pd.DataFrame(X), test_df=pd.DataFrame(X_test))
+    dm.transform(how='zeroone')
+    assert dm.test_df.values.min() >= 0
+    assert dm.test_df.values.max() <= 1
+    assert (dm.test_df.values == 0).any() and (dm.test_df.values == 1).any()
+    # NMF should be able to transform the scaled test set
+    dm.nmf(n_components=5, transform_test_df=True)
+    assert dm.nmf_test_df.shape == (5, 5)
@@ -79,3 +79,23 @@ def test_plier_output(shapes_test):
     assert dm.plier_test_df.shape == (params['n_test'], params['k'])
     assert dm.plier_weights.shape == (params['k'], params['p'])
 
+
+def test_fit_all_output(shapes_test):
+    """Test that fitting concurrently gives the same shapes as fitting in turn."""
+    params, exp_data = shapes_test
+    algorithms = ['pca', 'ica', 'nmf']
+    # the (untransformed) simulated data is nonnegative, as NMF requires
+    dm = DataModel(df=exp_data['train'], test_df=exp_data['test'])
+    dm.fit_all(n_components=params['k'], algorithms=algorithms,
+               transform_test_df=True)
+    seq_dm = DataModel(df=exp_data['train'], test_df=exp_data['test'])
+    seq_dm.pca(n_components=params['k'], transform_test_df=True)
+    seq_dm.ica(n_components=params['k'], transform_test_df=True)
+    seq_dm.nmf(n_components=params['k'], transform_test_df=True)
+    for alg in algorithms:
+        assert getattr(dm, '{}_df'.format(alg)).shape == (
+                getattr(seq_dm, '{}_df'.format(alg)).shape)
+        assert getattr(dm, '{}_test_df'.format(alg)).shape == (
+                getattr(seq_dm, '{}_test_df'.format(alg)).shape)
+        assert getattr(dm, '{}_df'.format(alg)).shape == (params['n_train'],
+                                                           params['k'])
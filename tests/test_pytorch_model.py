@@ -0,0 +1,135 @@
+import os
+import pytest
+import tempfile
+import numpy as np
+from sklearn.linear_model import Lasso, LinearRegression, LogisticRegression
+
+import sys; sys.path.append('.')
+import config as cfg
+from utilities.pytorch_model import TorchLR
+
+@pytest.fixture
+def regression_data():
+    # n = number of samples
+    # p = number of features
+    np.random.seed(cfg.default_seed)
+    n, p = 200, 5
+    X = np.random.normal(size=(n, p))
+    coefs = np.random.normal(size=(p,))
+    y = X @ coefs + 0.5 + np.random.normal(scale=0.1, size=(n,))
+    return X[:150], X[150:], y[:150], y[150:]
+
+
+@pytest.fixture
+def classify_data(regression_data):
+    X_train, X_test, y_train, y_test = regression_data
+    # sample labels from a logistic model, so that the classes overlap
+    # (otherwise the unpenalized solution is at infinity)
+    np.random.seed(cfg.default_seed)
+    X = np.concatenate((X_train, X_test))
+    probs = 1 / (1 + np.exp(-(X @ np.linspace(-1, 1, X.shape[1]) + 0.5)))
+    y = (np.random.uniform(size=probs.shape) < probs).astype('int')
+    return X_train, X_test, y[:len(X_train)], y[len(X_train):]
+
+
+def _train(X_train, X_test, y_train, y_test, solver, l1_penalty=0.0,
+           num_epochs=100, classify=False, **kwargs):
+    params_map = {
+        'learning_rate': [0.001],
+        'batch_size': [50],
+        'num_epochs': [num_epochs],
+        'l1_penalty': [l1_penalty]
+    }
+    if 'network_file' in kwargs:
+        params_map['network_penalty'] = [kwargs.pop('network_penalty')]
+    model = TorchLR(params_map, seed=cfg.default_seed, solver=solver,
+                    **kwargs)
+    model.classify = classify
+    model.train_torch_model(X_train, X_test, y_train, y_test,
+                            save_weights=True)
+    # bias is first, then weights
+    return model, model.last_weights
+
+
+def test_lbfgs_vs_sklearn(regression_data):
+    """Test L-BFGS solution against sklearn least squares."""
+    X_train, X_test, y_train, y_test = regression_data
+    _, weights = _train(X_train, X_test, y_train, y_test, 'lbfgs')
+    sk_model = LinearRegression().fit(X_train, y_train)
+    assert np.allclose(weights[0], sk_model.intercept_, atol=1e-2)
+    assert np.allclose(weights[1:], sk_model.coef_, atol=1e-2)
+
+
+def test_lbfgs_l1_penalty():
+    """Test that L-BFGS can't be used with an L1 penalty."""
+    params_map = {
+        'learning_rate': [0.001],
+        'batch_size': [50],
+        'num_epochs': [100],
+        'l1_penalty': [0, 0.1]
+    }
+    with pytest.raises(ValueError):
+        TorchLR(params_map, solver='lbfgs')
+
+
+def test_newton_vs_sklearn(regression_data):
+    """Test Newton solution against sklearn least squares."""
+    X_train, X_test, y_train, y_test = regression_data
+    _, weights = _train(X_train, X_test, y_train, y_test, 'newton')
+    sk_model = LinearRegression().fit(X_train, y_train)
+    assert np.allclose(weights[0], sk_model.intercept_, atol=1e-3)
+    assert np.allclose(weights[1:], sk_model.coef_, atol=1e-3)
+
+
+def test_newton_l1_vs_sklearn(regression_data):
+    """Test L1-penalized Newton solution against sklearn lasso."""
+    X_train, X_test, y_train, y_test = regression_data
+    l1_penalty = 0.2
+    _, weights = _train(X_train, X_test, y_train, y_test, 'newton',
+                        l1_penalty=l1_penalty)
+    # sklearn minimizes 1/(2n) * ||y - Xw||^2 + alpha * ||w||_1, which is
+    # half of the mean squared error + l1_penalty * ||w||_1
+    sk_model = Lasso(alpha=l1_penalty/2, tol=1e-10,
+                     max_iter=100000).fit(X_train, y_train)
+    assert np.allclose(weights[0], sk_model.intercept_, atol=1e-3)
+    assert np.allclose(weights[1:], sk_model.coef_, atol=1e-3)
+    # soft-thresholding should zero out the same weights as sklearn, exactly
+    assert np.array_equal(weights[1:] == 0, sk_model.coef_ == 0)
+
+
+def test_newton_classify_vs_sklearn(classify_data):
+    """Test Newton/IRLS solution against sklearn logistic regression."""
+    X_train, X_test, y_train, y_test = classify_data
+    _, weights = _train(X_train, X_test, y_train, y_test, 'newton',
+                        classify=True)
+    # TorchLR weights the positive class by the label imbalance
+    pos_weight = (y_train == 0).sum() / (y_train == 1).sum()
+    sk_model = LogisticRegression(penalty='none', solver='lbfgs', tol=1e-10,
+                                  max_iter=10000,
+                                  class_weight={0: 1, 1: pos_weight})
+    sk_model.fit(X_train, y_train)
+    assert np.allclose(weights[0], sk_model.intercept_, atol=1e-3)
+    assert np.allclose(weights[1:], sk_model.coef_.flatten(), atol=1e-3)
+
+
+def test_newton_network_features(regression_data):
+    """Test that network features can be a boolean mask or list of indices."""
+    X_train, X_test, y_train, y_test = regression_data
+    # path graph over the first 3 features
+    tf = tempfile.NamedTemporaryFile(mode='w', delete=False)
+    tf.write('0\t1\t1.0\n1\t2\t1.0\n')
+    tf.close()
+    mask = np.zeros(X_train.shape[1], dtype=bool)
+    mask[:3] = True
+    results = []
+    for network_features in [mask, [0, 1, 2]]:
+        _, weights = _train(X_train, X_test, y_train, y_test, 'newton',
+                            network_file=tf.name, network_penalty=1.0,
+                            network_features=network_features)
+        results.append(weights)
+    os.remove(tf.name)
+    assert np.allclose(results[0], results[1])
+    # the network penalty should pull connected weights together
+    _, unpenalized = _train(X_train, X_test, y_train, y_test, 'newton')
+    assert (np.abs(np.diff(results[0][1:4])).sum() <
+            np.abs(np.diff(unpenalized[1:4])).sum())
@@ -1,12 +1,15 @@
 import os
 import time
+import contextlib
+import functools
 import numpy as np
 import pandas as pd
 import networkx as nx
 import scipy.sparse as sp
 import torch
 import torch.nn as nn
-import torch.utils.data as data_utils
+import torch.nn.functional as F
+from joblib import Parallel, cpu_count, delayed
 from sklearn.model_selection import (
     KFold,
     cross_val_predict
@@ -40,6 +43,10 @@ class TorchLR:
                  network_features=None,
                  learning_curves=False,
                  use_gpu=False,
+                 compile_model=False,
+                 batch_models=False,
+                 n_jobs=1,
+                 solver='adam',
                  verbose=False):
 
         # set random seeds
@@ -80,13 +87,36 @@ class TorchLR:
         # if there are multiple choices, select num_iters parameter
         # combinations to be tested during the parameter search
         if max_params_length > 1:
-            params_map = get_params_map(params_map,
-                                        self.seed,
-                                        num_iters=num_iters)
+            params_map = self.get_params_map(params_map,
+                                             self.seed,
+                                             num_iters=num_iters)
         self.params_map = params_map
         self.num_inner_folds = num_inner_folds
         self.use_gpu = use_gpu
+        # compiling the model with TorchInductor (requires PyTorch >= 2.0,
+        # ignored otherwise) cuts per-step overhead, but compiling takes a
+        # while, so it's only worthwhile for long training runs
+        self.compile_model = compile_model and hasattr(torch, 'compile')
+        # if True, train all parameter sets with the same batch size together
+        # during the parameter search (see _fit_batched; this always trains
+        # in full precision, and ignores compile_model)
+        self.batch_models = batch_models
+        # number of inner CV folds to run in parallel (-1 means one per core),
+        # see torch_param_selection
+        self.n_jobs = n_jobs
+        # optimizer to train the model with: 'adam' runs minibatch Adam,
+        # 'lbfgs' runs full-batch L-BFGS (see _train_lbfgs), 'newton' runs
+        # full-batch proximal Newton/IRLS (see _train_newton)
+        if solver not in ['adam', 'lbfgs', 'newton']:
+            raise ValueError('solver must be one of "adam", "lbfgs", or "newton".')
+        if solver == 'lbfgs' and any(l1_penalty != 0 for l1_penalty
+                                                 in params_map['l1_penalty']):
+            raise ValueError('the lbfgs solver does not support an L1 penalty, '
+                             'use the newton or adam solver instead.')
+        self.solver = solver
         self.learning_curves = learning_curves
+        # TODO: make this a constructor option
+        self.classify = False
         self.verbose = verbose
 
 
@@ -142,12 +172,16 @@ class TorchLR:
             Maps hyperparameter names to lists of values to try.
 
         """
-        import random; random.seed(seed)
+        # use a local random state, rather than reseeding the global one
+        rs = np.random.RandomState(seed)
         # sorting here ensures that results for models that share the same
         # parameters will have the same choices, and thus will be easily
         # comparable
         param_options = sorted(param_choices.items())
-        params_map = {p: [random.choice(vals) for _ in range(num_iters)]
+        # choosing from an object array keeps the original Python types
+        # (e.g. int batch sizes) in the returned lists
+        params_map = {p: rs.choice(np.array(vals, dtype=object),
+                                   size=num_iters).tolist()
                          for p, vals in param_options}
         return params_map
 
@@ -213,109 +247,120 @@ class TorchLR:
              (predictions on training data, predictions on testing data),
              (binarized predictions on training/test data))
         """
-        # TODO: make this a class option
-        classify = False
+        tensors = self._prepare_tensors(X_train, X_test, y_train, y_test)
+        return self._fit_eval(tensors, params,
+                              save_weights=save_weights,
+                              learning_curves=learning_curves)
 
-        if self.verbose:
-            t = time.time()
 
-        learning_rate = params['learning_rate']
-        batch_size = params['batch_size']
-        num_epochs = params['num_epochs']
-        l1_penalty = params['l1_penalty']
+    def _prepare_tensors(self, X_train, X_test, y_train, y_test):
+        """Convert a train/test split to tensors on the training device.
 
-        if self.laplacian is not None:
-            network_penalty = params['network_penalty']
+        This only needs to happen once per split, so code that trains several
+        models on the same split (e.g. the parameter search in torch_tuning)
+        should call this once and pass the result to _fit_eval for each model.
+
+        Returns
+        -------
+        tuple : (X_tr, X_ts, y_tr, y_ts, pos_weight)
+            Tensors for training/test data and labels, and the weight for the
+            positive class in the loss function (None if not classifying)
+        """
+        device = torch.device('cuda' if self.use_gpu else 'cpu')
 
         # Weight loss function based on training data label imbalance
         # see, e.g. https://discuss.pytorch.org/t/about-bcewithlogitslosss-pos-weights/22567/2
         #
         # TODO: could add a function argument to turn this on/off (but in
         # general it seems to give slightly better results)
-        if classify:
-            train_count = np.bincount(y_train)
-            pos_weight = train_count[0] / train_count[1]
+        pos_weight = None
+        if self.classify:
+            # labels are 0/1, so the nonzero labels are the positive samples
+            num_pos = np.count_nonzero(y_train)
+            num_neg = len(y_train) - num_pos
+            pos_weight = num_neg / num_pos
             if self.verbose:
-                print('\n[0, 1]: {} (pos_weight={:.4f})'.format(train_count, pos_weight))
-
-        device = torch.device('cuda' if self.use_gpu else 'cpu')
-        X_tr = torch.stack([torch.Tensor(x) for x in X_train]).to(device)
-        X_ts = torch.stack([torch.Tensor(x) for x in X_test]).to(device)
-        y_tr = torch.Tensor(y_train).view(-1, 1).to(device)
-        y_ts = torch.Tensor(y_test).view(-1, 1).to(device)
-        if classify:
+                print('\n[0, 1]: [{} {}] (pos_weight={:.4f})'.format(
+                        num_neg, num_pos, pos_weight))
             pos_weight = torch.Tensor([pos_weight]).to(device)
 
-        train_loader = data_utils.DataLoader(
-                data_utils.TensorDataset(X_tr, y_tr),
-                batch_size=batch_size, shuffle=True)
+        X_tr = self._to_device(X_train, device)
+        X_ts = self._to_device(X_test, device)
+        y_tr = self._to_device(y_train, device).view(-1, 1)
+        y_ts = self._to_device(y_test, device).view(-1, 1)
+
+        return X_tr, X_ts, y_tr, y_ts, pos_weight
+
+
+    def _to_device(self, array, device):
+        """Convert a numpy array to a float32 tensor on the given device.
+
+        The array is converted in one shot (the float32 conversion is the
+        only copy, and is skipped if the data is already float32) rather than
+        building a tensor for each row and stacking them. Copies to the GPU
+        are staged through page-locked memory, so they can run
+        asynchronously with the DMA engine (kernels on the same stream still
+        wait for the copy to finish).
+        """
+        tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+        if device.type == 'cuda':
+            tensor = tensor.pin_memory().to(device, non_blocking=True)
+        return tensor
+
+
+    def _get_amp(self):
+        """Get a context manager and gradient scaler for mixed precision.
+
+        On the GPU, the forward pass/loss run in mixed precision and the loss
+        is scaled to avoid gradient underflow (if supported by the installed
+        PyTorch version); the parameters and penalty terms stay in float32.
+        Otherwise, the context manager does nothing and the scaler is None.
+        """
+        if self.use_gpu and hasattr(torch, 'autocast'):
+            return (functools.partial(torch.autocast, 'cuda',
+                                      dtype=torch.float16),
+                    torch.cuda.amp.GradScaler())
+        # contextlib.suppress() with no arguments is a no-op context
+        return contextlib.suppress, None
+
+
+    def _fit_eval(self, tensors, params, save_weights=False,
+                  learning_curves=False):
+        """Train a model on tensors from _prepare_tensors, and evaluate it.
+
+        See torch_model for a description of the parameters/return values.
+        """
+        if self.verbose:
+            t = time.time()
+
+        X_tr, X_ts, y_tr, y_ts, pos_weight = tensors
+        device = X_tr.device
+
+        l1_penalty = params['l1_penalty']
 
-        model = LogisticRegression(X_train.shape[1]).to(device)
+        model = LogisticRegression(X_tr.shape[1]).to(device)
+        # parameters are accessed through model, and the forward pass goes
+        # through forward (the compiled model, if applicable)
+        forward = model
+        if self.compile_model:
+            forward = torch.compile(model, mode='reduce-overhead',
+                                    fullgraph=True)
 
         # pos_weight is a scalar, the weight for the 1 class
-        if classify:
+        if self.classify:
             criterion = nn.BCEWithLogitsLoss(pos_weight=pos_weight)
         else:
             criterion = nn.MSELoss()
-        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-
-        for epoch in range(num_epochs):
-            running_loss = 0.0
-            for i, (X_batch, y_batch) in enumerate(train_loader):
-                optimizer.zero_grad()
-                y_pred = model(X_batch)
-                loss = criterion(y_pred, y_batch)
 
-                # add l1 loss
-                l1_loss = sum(torch.norm(param, 1)
-                                for name, param in model.named_parameters()
-                                if 'bias' not in name)
-                loss += l1_penalty * l1_loss
-
-                # add L2 network penalty if applicable
-                if self.laplacian is not None:
-                    # get weights w/gradients
-                    w = [param for name, param in model.named_parameters()
-                               if 'bias' not in name][0]
-                    # filter for features that are in the network
-                    w = w[:, self.network_features]
-                    # calculate w^T @ L @ w
-                    network_loss = torch.mm(
-                        w.view(1, -1),
-                        torch.sparse.mm(self.laplacian, w.view(-1, 1)))
-                    loss += (network_penalty * network_loss).view(-1)[0]
-
-                running_loss += loss
-                loss.backward()
-                optimizer.step()
-
-            if learning_curves:
-                # save train loss and test loss on whole dataset after each epoch
-                y_pred_train = model(X_tr)
-                y_pred_test = model(X_ts)
-                self.monitor_['train_loss'].append((
-                    criterion(y_pred_train, y_tr)
-                ).item())
-                self.monitor_['test_loss'].append((
-                    criterion(y_pred_test, y_ts)
-                ).item())
-                # also save l1 loss
-                self.monitor_['l1_loss'].append((
-                    sum(torch.norm(param, 1)
-                            for name, param in model.named_parameters()
-                            if 'bias' not in name)
-                ).item())
-                # also save L2 network loss
-                network_weights = [param for name, param in model.named_parameters()
-                                         if 'bias' not in name][0]
-                network_weights = network_weights[:, self.network_features]
-                network_loss = torch.mm(
-                    w.view(1, -1),
-                    torch.sparse.mm(self.laplacian, w.view(-1, 1)))
-                self.monitor_['network_loss'].append((
-                    (network_loss).view(-1)[0]
-                ).item())
-                network_weights = model.linear.weight.data.reshape(-1)
+        if self.solver == 'lbfgs':
+            self._train_lbfgs(model, forward, criterion, tensors, params,
+                              learning_curves=learning_curves)
+        elif self.solver == 'newton':
+            self._train_newton(model, forward, criterion, tensors, params,
+                               learning_curves=learning_curves)
+        else:
+            self._train_adam(model, forward, criterion, tensors, params,
+                             learning_curves=learning_curves)
 
         if save_weights:
             # bias is first, then weights in order
@@ -329,41 +374,477 @@ class TorchLR:
                 weights = model.linear.weight.data.numpy().flatten()
                 self.last_weights = np.concatenate((bias, weights))
 
-        y_pred_train = model(X_tr)
-        y_pred_test = model(X_ts)
-
-        train_loss = (
-                criterion(y_pred_train, y_tr) +
-                l1_penalty * sum(torch.norm(param, 1) for param in model.parameters())
-        ).item()
+        # inference_mode (PyTorch >= 1.9) also skips version counter/view
+        # tracking; fall back to no_grad on older versions
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            y_pred_train = forward(X_tr)
+            y_pred_test = forward(X_ts)
 
-        test_loss = (
-                criterion(y_pred_test, y_ts) +
-                l1_penalty * sum(torch.norm(param, 1) for param in model.parameters())
-        ).item()
+            # the parameters are fixed now, so the L1 term is the same for
+            # the train and test losses
+            l1_loss = l1_penalty * (model.linear.weight.abs().sum() +
+                                    model.linear.bias.abs().sum()).item()
+            train_loss = criterion(y_pred_train, y_tr).item() + l1_loss
+            test_loss = criterion(y_pred_test, y_ts).item() + l1_loss
 
         if self.verbose:
             print('(time: {:.3f} sec)'.format(time.time() - t))
 
-        if self.use_gpu:
-            y_pred_train = y_pred_train.cpu().detach().numpy()
-            y_pred_test = y_pred_test.cpu().detach().numpy()
-        else:
-            y_pred_train = y_pred_train.detach().numpy()
-            y_pred_test = y_pred_test.detach().numpy()
-
-        if classify:
-            y_pred_bn_train = (y_pred_train > 0).astype('int')
-            y_pred_bn_test = (y_pred_test > 0).astype('int')
+        # threshold on the training device, so each output only needs to be
+        # copied back to the host once (.cpu() is a no-op for CPU tensors)
+        if self.classify:
+            y_pred_bn_train = (y_pred_train > 0).to(torch.int8).cpu().numpy()
+            y_pred_bn_test = (y_pred_test > 0).to(torch.int8).cpu().numpy()
         else:
             y_pred_bn_train = np.array([])
             y_pred_bn_test = np.array([])
 
+        y_pred_train = y_pred_train.cpu().numpy()
+        y_pred_test = y_pred_test.cpu().numpy()
+
         return ((train_loss, test_loss),
                 (y_pred_train, y_pred_test),
                 (y_pred_bn_train, y_pred_bn_test))
 
 
+    def _network_loss(self, model):
+        """Calculate the network penalty w^T @ L @ w for the model weights w.
+
+        Only the weights for features in the network are included.
+        """
+        w = model.linear.weight[:, self.network_features]
+        network_loss = torch.mm(
+            w.view(1, -1),
+            torch.sparse.mm(self.laplacian, w.view(-1, 1)))
+        return network_loss.view(-1)[0]
+
+
+    def _record_learning_curves(self, model, forward, criterion, tensors):
+        """Save losses on the whole train/test datasets to self.monitor_."""
+        X_tr, X_ts, y_tr, y_ts, _ = tensors
+        y_pred_train = forward(X_tr)
+        y_pred_test = forward(X_ts)
+        self.monitor_['train_loss'].append((
+            criterion(y_pred_train, y_tr)
+        ).item())
+        self.monitor_['test_loss'].append((
+            criterion(y_pred_test, y_ts)
+        ).item())
+        # also save l1 loss
+        self.monitor_['l1_loss'].append(
+            model.linear.weight.abs().sum().item())
+        # also save L2 network loss
+        if self.laplacian is not None:
+            self.monitor_['network_loss'].append(
+                self._network_loss(model).item())
+
+
+    def _train_adam(self, model, forward, criterion, tensors, params,
+                    learning_curves=False):
+        """Train a model using minibatch Adam."""
+        X_tr, X_ts, y_tr, y_ts, _ = tensors
+        device = X_tr.device
+
+        learning_rate = params['learning_rate']
+        batch_size = params['batch_size']
+        num_epochs = params['num_epochs']
+        l1_penalty = params['l1_penalty']
+
+        if self.laplacian is not None:
+            network_penalty = params['network_penalty']
+
+        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+        autocast, grad_scaler = self._get_amp()
+
+        # the training data is already a single tensor on the training device,
+        # so shuffle and batch it by indexing directly rather than going
+        # through a DataLoader (which adds sampling/collation overhead for
+        # each batch)
+        num_samples = X_tr.shape[0]
+        for epoch in range(num_epochs):
+            perm = torch.randperm(num_samples, device=device)
+            for start in range(0, num_samples, batch_size):
+                batch_ixs = perm[start:start+batch_size]
+                X_batch, y_batch = X_tr[batch_ixs], y_tr[batch_ixs]
+                optimizer.zero_grad()
+                with autocast():
+                    y_pred = forward(X_batch)
+                    loss = criterion(y_pred, y_batch)
+
+                # add l1 loss (on the weights only, not the bias)
+                l1_loss = model.linear.weight.abs().sum()
+                loss += l1_penalty * l1_loss
+
+                # add L2 network penalty if applicable
+                if self.laplacian is not None:
+                    loss += network_penalty * self._network_loss(model)
+
+                if grad_scaler is not None:
+                    grad_scaler.scale(loss).backward()
+                    grad_scaler.step(optimizer)
+                    grad_scaler.update()
+                else:
+                    loss.backward()
+                    optimizer.step()
+
+            if learning_curves:
+                # save train loss and test loss on whole dataset after each epoch
+                self._record_learning_curves(model, forward, criterion, tensors)
+
+
+    def _train_lbfgs(self, model, forward, criterion, tensors, params,
+                     learning_curves=False, tol=1e-7):
+        """Train a model using full-batch L-BFGS.
+
+        L-BFGS assumes a smooth loss, so this only supports models without an
+        L1 penalty (the L1 penalty isn't differentiable at zero; see
+        _train_newton for a solver that handles it). The loss is the data
+        loss plus the network penalty, if applicable.
+
+        Each iteration uses the whole training set, so batch_size and
+        learning_rate aren't used; num_epochs is the maximum number of L-BFGS
+        iterations (each of which may evaluate the loss more than once during
+        the line search), and training stops early if the loss changes by
+        less than tol.
+        """
+        X_tr, X_ts, y_tr, y_ts, _ = tensors
+
+        if self.laplacian is not None:
+            network_penalty = params['network_penalty']
+
+        if learning_curves:
+            # run one iteration per step, to record losses after each one
+            max_iter, num_steps = 1, params['num_epochs']
+        else:
+            max_iter, num_steps = params['num_epochs'], 1
+        optimizer = torch.optim.LBFGS(model.parameters(), lr=1,
+                                      max_iter=max_iter,
+                                      tolerance_change=tol,
+                                      line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = criterion(forward(X_tr), y_tr)
+            if self.laplacian is not None:
+                loss += network_penalty * self._network_loss(model)
+            loss.backward()
+            return loss
+
+        prev_loss = None
+        for step in range(num_steps):
+            loss = optimizer.step(closure).item()
+
+            if learning_curves:
+                self._record_learning_curves(model, forward, criterion, tensors)
+
+            if prev_loss is not None and abs(prev_loss - loss) < tol:
+                break
+            prev_loss = loss
+
+
+    def _train_newton(self, model, forward, criterion, tensors, params,
+                      learning_curves=False, tol=1e-6, damping=1e-6,
+                      max_backtracks=20):
+        """Train a model using full-batch proximal Newton's method.
+
+        Each step minimizes a quadratic approximation of the smooth part of
+        the loss (the data loss plus the network penalty, if applicable)
+        around the current parameters. For the logistic loss this is
+        iteratively reweighted least squares; for the squared loss the
+        approximation is exact. Without an L1 penalty the step is a single
+        linear solve with the Hessian; with one, the penalized quadratic is
+        minimized by cyclic coordinate descent with soft-thresholding (see
+        _newton_l1_step). Steps are halved until the full objective decreases.
+
+        The Hessian is (num_features+1) x (num_features+1), so this is only
+        practical for a modest number of features. batch_size and
+        learning_rate aren't used; num_epochs is the maximum number of Newton
+        steps, and training stops early once a step changes the parameters by
+        less than tol (in L2 norm). damping is added to the diagonal of the
+        Hessian, to keep it invertible when there are more features than
+        samples.
+        """
+        X_tr, X_ts, y_tr, y_ts, pos_weight = tensors
+        l1_penalty = params['l1_penalty']
+
+        # work in double precision, with the bias as the first parameter (this
+        # matches the order of last_weights)
+        X = torch.cat((torch.ones_like(X_tr[:, :1]), X_tr), dim=1).double()
+        y = y_tr.view(-1).double()
+        num_samples, num_params = X.shape
+        beta = torch.cat((model.linear.bias.detach().view(-1),
+                          model.linear.weight.detach().view(-1))).double()
+
+        # the L1 penalty applies to the weights only, not the bias
+        l1_mask = torch.ones_like(beta)
+        l1_mask[0] = 0
+
+        # the network penalty is quadratic in the weights, so its Hessian is
+        # constant and its value/gradient can be computed from it
+        penalty_hessian = torch.zeros(num_params, num_params,
+                                      dtype=X.dtype, device=X.device)
+        if self.laplacian is not None:
+            network_penalty = params['network_penalty']
+            # network_features can be a boolean mask or a list of indices
+            net_ixs = torch.from_numpy(
+                    np.arange(num_params - 1)[self.network_features] + 1
+            ).to(X.device)
+            penalty_hessian[net_ixs.view(-1, 1), net_ixs.view(1, -1)] = (
+                    2 * network_penalty * self.laplacian.to_dense().double())
+
+        if self.classify:
+            # pos_weight scales the loss on positive samples
+            pw = 1.0 if pos_weight is None else pos_weight.item()
+            sample_weights = pw * y + (1 - y)
+
+        def smooth_loss(beta):
+            z = torch.mv(X, beta)
+            if self.classify:
+                data_loss = (pw * y * F.softplus(-z) +
+                             (1 - y) * F.softplus(z)).mean()
+            else:
+                data_loss = ((z - y) ** 2).mean()
+            return data_loss + 0.5 * beta.dot(torch.mv(penalty_hessian, beta))
+
+        def objective(beta):
+            return (smooth_loss(beta) +
+                    l1_penalty * (l1_mask * beta).abs().sum()).item()
+
+        eye = torch.eye(num_params, dtype=X.dtype, device=X.device)
+        for epoch in range(params['num_epochs']):
+            # gradient/Hessian of the smooth loss, as derivatives with
+            # respect to the linear predictor z
+            z = torch.mv(X, beta)
+            if self.classify:
+                p = torch.sigmoid(z)
+                dz = sample_weights * p - pw * y
+                d2z = sample_weights * p * (1 - p)
+            else:
+                dz = 2 * (z - y)
+                d2z = torch.full_like(z, 2.0)
+            grad = (torch.mv(X.t(), dz) / num_samples +
+                    torch.mv(penalty_hessian, beta))
+            hess = (torch.mm(X.t() * d2z, X) / num_samples +
+                    penalty_hessian + damping * eye)
+
+            if l1_penalty == 0:
+                if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve'):
+                    step = -torch.linalg.solve(hess, grad.view(-1, 1)).view(-1)
+                else:
+                    # older versions of torch.solve take (B, A) and also
+                    # return the LU factorization
+                    step = -torch.solve(grad.view(-1, 1), hess)[0].view(-1)
+            else:
+                step = self._newton_l1_step(grad, hess, beta,
+                                            l1_penalty * l1_mask, tol)
+
+            # backtrack until the step decreases the objective (an undamped
+            # Newton step can overshoot for the logistic loss)
+            prev_obj = objective(beta)
+            t = 1.0
+            for _ in range(max_backtracks):
+                if objective(beta + t * step) <= prev_obj:
+                    break
+                t /= 2
+            else:
+                # no decrease in the step direction, so we're at a minimum
+                break
+            beta = beta + t * step
+
+            with torch.no_grad():
+                model.linear.bias.copy_(beta[:1])
+                model.linear.weight.copy_(beta[1:].view(1, -1))
+
+            if learning_curves:
+                self._record_learning_curves(model, forward, criterion, tensors)
+
+            if (t * step).norm().item() < tol:
+                break
+
+
+    @staticmethod
+    def _newton_l1_step(grad, hess, beta, thresholds, tol, max_sweeps=100):
+        """Get a proximal Newton step by cyclic coordinate descent.
+
+        Minimizes grad^T d + 1/2 d^T hess d + sum(thresholds * |beta + d|)
+        over the step d. Each coordinate update is a soft-thresholded
+        univariate Newton step, as in glmnet; the sweeps stop once no
+        coordinate changes by more than tol.
+
+        Coordinate descent is inherently sequential, so this runs on the CPU
+        (in numpy) regardless of where the tensors are.
+        """
+        g = grad.cpu().numpy()
+        H = hess.cpu().numpy()
+        lam = thresholds.cpu().numpy()
+        b0 = beta.cpu().numpy()
+        b = b0.copy()
+        h_diag = np.diag(H)
+        # gradient of the quadratic model at b, i.e. grad + hess @ (b - b0)
+        r = g.copy()
+        for sweep in range(max_sweeps):
+            max_change = 0.0
+            for j in range(len(b)):
+                u = h_diag[j] * b[j] - r[j]
+                b_j = np.sign(u) * max(abs(u) - lam[j], 0.0) / h_diag[j]
+                delta = b_j - b[j]
+                if delta != 0.0:
+                    r += delta * H[:, j]
+                    b[j] = b_j
+                    max_change = max(max_change, abs(delta))
+            if max_change < tol:
+                break
+        return torch.from_numpy(b - b0).to(beta.device)
+
+
+    def _fit_batched(self, tensors, params_list):
+        """Train and evaluate several models with different parameters at once.
+
+        The models are trained on the same data with the same minibatch size,
+        so they can be packed into a single (n_features x n_models) linear
+        layer: each minibatch step is then one matrix multiply for all of the
+        models, rather than one for each model. The models don't share any
+        parameters, so summing their losses before the backward pass leaves
+        the gradient for each model unchanged. Each model has its own Adam
+        parameter group (so it can have its own learning rate), and stops
+        being updated after its own number of epochs.
+
+        Compared to training the models one at a time with _fit_eval, the
+        models see the same shuffled minibatches (and their initial weights
+        are drawn in a different order). Training always runs in full
+        precision: with mixed precision, the models would share one gradient
+        scaler, so an overflow in any one of them would skip the step for
+        all of them. The model also isn't compiled, even if compile_model
+        is set.
+
+        Parameters
+        ----------
+        tensors : tuple
+            Train/test data, as returned by _prepare_tensors
+
+        params_list : list of dict, (str: mixed)
+            Hyperparameters for each model (all with the same batch_size)
+
+        Returns
+        -------
+        list of tuple
+            Losses/predictions for each model, in the same format as the
+            return value of _fit_eval
+        """
+        if self.verbose:
+            t = time.time()
+
+        X_tr, X_ts, y_tr, y_ts, pos_weight = tensors
+        device = X_tr.device
+        num_models = len(params_list)
+        batch_size = params_list[0]['batch_size']
+        assert all(params['batch_size'] == batch_size
+                   for params in params_list), (
+            'models trained together must have the same batch size')
+
+        def get_param_vector(name):
+            return torch.tensor([params[name] for params in params_list],
+                                dtype=torch.float32, device=device)
+
+        l1_penalty = get_param_vector('l1_penalty')
+        if self.laplacian is not None:
+            network_penalty = get_param_vector('network_penalty')
+        num_epochs = [params['num_epochs'] for params in params_list]
+
+        models = [LogisticRegression(X_tr.shape[1]).to(device)
+                    for _ in range(num_models)]
+        optimizer = torch.optim.Adam([
+            {'params': model.parameters(), 'lr': params['learning_rate']}
+                for model, params in zip(models, params_list)
+        ])
+
+        def forward(X):
+            # [n_samples, n_models] outputs, one column for each model
+            weights = torch.cat([model.linear.weight for model in models])
+            biases = torch.cat([model.linear.bias for model in models])
+            return torch.addmm(biases, X, weights.t()), weights, biases
+
+        # losses are averaged over samples separately for each model
+        if self.classify:
+            criterion = nn.BCEWithLogitsLoss(pos_weight=pos_weight,
+                                             reduction='none')
+        else:
+            criterion = nn.MSELoss(reduction='none')
+
+        def model_losses(y_pred, y):
+            return criterion(y_pred, y.expand_as(y_pred)).mean(dim=0)
+
+        num_samples = X_tr.shape[0]
+        for epoch in range(max(num_epochs)):
+            # stop updating models that have finished training (with a
+            # learning rate of 0, Adam leaves the parameters unchanged)
+            for ix, model_epochs in enumerate(num_epochs):
+                if epoch == model_epochs:
+                    optimizer.param_groups[ix]['lr'] = 0.0
+
+            perm = torch.randperm(num_samples, device=device)
+            for start in range(0, num_samples, batch_size):
+                batch_ixs = perm[start:start+batch_size]
+                X_batch, y_batch = X_tr[batch_ixs], y_tr[batch_ixs]
+                optimizer.zero_grad()
+                y_pred, weights, _ = forward(X_batch)
+                loss = model_losses(y_pred, y_batch)
+
+                # add l1 loss (on the weights only, not the bias)
+                loss = loss + l1_penalty * weights.abs().sum(dim=1)
+
+                # add L2 network penalty if applicable
+                if self.laplacian is not None:
+                    # w^T @ L @ w for each model's weights w
+                    w = weights[:, self.network_features]
+                    network_loss = (
+                        w.t() * torch.sparse.mm(self.laplacian, w.t())
+                    ).sum(dim=0)
+                    loss = loss + network_penalty * network_loss
+
+                loss = loss.sum()
+                loss.backward()
+                optimizer.step()
+
+        # no gradients are needed for the final evaluation (see _fit_eval)
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            y_pred_train, weights, biases = forward(X_tr)
+            y_pred_test, _, __ = forward(X_ts)
+
+            l1_loss = l1_penalty * (weights.abs().sum(dim=1) + biases.abs())
+            train_losses = (model_losses(y_pred_train, y_tr) + l1_loss).tolist()
+            test_losses = (model_losses(y_pred_test, y_ts) + l1_loss).tolist()
+
+        if self.verbose:
+            print('(time: {:.3f} sec)'.format(time.time() - t))
+
+        # threshold all the models at once on the training device, as in
+        # _fit_eval, then slice out each model's predictions below
+        if self.classify:
+            y_pred_bn_train = (y_pred_train > 0).to(torch.int8).cpu().numpy()
+            y_pred_bn_test = (y_pred_test > 0).to(torch.int8).cpu().numpy()
+
+        y_pred_train = y_pred_train.cpu().numpy()
+        y_pred_test = y_pred_test.cpu().numpy()
+
+        results = []
+        for ix in range(num_models):
+            # keep the [n_samples, 1] shape of the predictions from _fit_eval
+            model_pred_train = y_pred_train[:, ix:ix+1]
+            model_pred_test = y_pred_test[:, ix:ix+1]
+            if self.classify:
+                model_pred_bn_train = y_pred_bn_train[:, ix:ix+1]
+                model_pred_bn_test = y_pred_bn_test[:, ix:ix+1]
+            else:
+                model_pred_bn_train = np.array([])
+                model_pred_bn_test = np.array([])
+            results.append(((train_losses[ix], test_losses[ix]),
+                            (model_pred_train, model_pred_test),
+                            (model_pred_bn_train, model_pred_bn_test)))
+        return results
+
+
     def torch_param_selection(self, X_train, y_train):
         """Cross-validate to select best parameters from a set of possibilities.
 
@@ -373,19 +854,35 @@ class TorchLR:
         # k-fold cross-validation over the training data
         kf = KFold(n_splits=self.num_inner_folds, shuffle=True,
                    random_state=self.seed)
-        results_df = None
-        for fold, (subtrain_ixs, tune_ixs) in enumerate(kf.split(X_train), 1):
-            X_subtrain, X_tune = X_train[subtrain_ixs], X_train[tune_ixs]
-            y_subtrain, y_tune = y_train[subtrain_ixs], y_train[tune_ixs]
-            if self.verbose:
-                print('Running inner CV fold {} of {}'.format(
-                        fold, self.num_inner_folds))
-            result_df = self.torch_tuning(X_subtrain, X_tune, y_subtrain, y_tune)
-            result_df['fold'] = fold
-            if results_df is None:
-                results_df = result_df
-            else:
-                results_df = pd.concat((results_df, result_df), ignore_index=True)
+        splits = list(enumerate(kf.split(X_train), 1))
+
+        # the folds are independent, so they can run in parallel
+        num_workers = self.n_jobs if self.n_jobs > 0 else cpu_count()
+        num_workers = min(num_workers, self.num_inner_folds)
+        if num_workers == 1:
+            fold_dfs = [self._run_fold(fold, X_train, y_train,
+                                       subtrain_ixs, tune_ixs)
+                          for fold, (subtrain_ixs, tune_ixs) in splits]
+        elif self.use_gpu:
+            # use threads (the training loop spends most of its time
+            # launching kernels, which releases the GIL), with each fold on
+            # its own CUDA stream so kernels from different folds can overlap
+            streams = [torch.cuda.Stream() for _ in splits]
+            fold_dfs = Parallel(n_jobs=num_workers, backend='threading')(
+                delayed(self._run_fold)(fold, X_train, y_train,
+                                        subtrain_ixs, tune_ixs,
+                                        stream=streams[fold-1])
+                  for fold, (subtrain_ixs, tune_ixs) in splits)
+            torch.cuda.synchronize()
+        else:
+            # use processes, splitting the cores between them
+            num_threads = max(1, cpu_count() // num_workers)
+            fold_dfs = Parallel(n_jobs=num_workers)(
+                delayed(self._run_fold)(fold, X_train, y_train,
+                                        subtrain_ixs, tune_ixs,
+                                        num_threads=num_threads)
+                  for fold, (subtrain_ixs, tune_ixs) in splits)
+        results_df = pd.concat(fold_dfs, ignore_index=True)
 
         # get the index of the parameter set that performed the best on
         # average across folds
@@ -405,27 +902,75 @@ class TorchLR:
         return results_df, best_params
 
 
+    def _run_fold(self, fold, X_train, y_train, subtrain_ixs, tune_ixs,
+                  stream=None, num_threads=None):
+        """Run parameter search on a single inner CV fold.
+
+        stream is the CUDA stream to run the fold on, and num_threads is the
+        number of threads for PyTorch to use (if not provided, the current
+        stream/number of threads are used).
+        """
+        # seed each fold separately, so results don't depend on the order
+        # the folds run in (or whether they run in parallel); note that
+        # folds running on threads share the random number generator, so
+        # results aren't reproducible in that case
+        torch.manual_seed(self.seed + fold)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        X_subtrain, X_tune = X_train[subtrain_ixs], X_train[tune_ixs]
+        y_subtrain, y_tune = y_train[subtrain_ixs], y_train[tune_ixs]
+        if self.verbose:
+            print('Running inner CV fold {} of {}'.format(
+                    fold, self.num_inner_folds))
+        if stream is not None:
+            with torch.cuda.stream(stream):
+                result_df = self.torch_tuning(X_subtrain, X_tune,
+                                              y_subtrain, y_tune)
+        else:
+            result_df = self.torch_tuning(X_subtrain, X_tune,
+                                          y_subtrain, y_tune)
+        result_df['fold'] = fold
+        return result_df
+
+
     def torch_tuning(self, X_subtrain, X_tune, y_subtrain, y_tune):
         """Run parameter search on a single subtrain/tune split."""
-        result = {
-            'param_set': [],
-            'train/tune': [],
-            'loss': [],
-            'auroc': []
-        }
-        for param in self.params_map.keys():
-            result[param] = []
         num_iters = len(self.params_map[list(self.params_map.keys())[0]])
+        # each parameter set gets two rows in the results, one for the
+        # subtrain set (at index 2*ix) and one for the tune set (at 2*ix+1)
+        loss_col = np.empty(2 * num_iters)
+        auroc_col = np.empty(2 * num_iters)
+        # every parameter set is trained on the same data, so only convert it
+        # to tensors (and copy it to the GPU, if applicable) once
+        tensors = self._prepare_tensors(X_subtrain, X_tune, y_subtrain, y_tune)
+        param_sets = [{k: v[ix] for k, v in self.params_map.items()}
+                         for ix in range(num_iters)]
+
+        # train parameter sets that share a batch size together (this only
+        # applies to minibatch training with Adam)
+        batch_models = self.batch_models and self.solver == 'adam'
+        if batch_models:
+            fit_results = [None] * num_iters
+            for batch_size in sorted(set(p['batch_size'] for p in param_sets)):
+                ixs = [ix for ix, p in enumerate(param_sets)
+                          if p['batch_size'] == batch_size]
+                if self.verbose:
+                    print('-- Running {} parameter sets with batch size {}...'.format(
+                          len(ixs), batch_size), end='')
+                batch_results = self._fit_batched(
+                        tensors, [param_sets[ix] for ix in ixs])
+                for ix, fit_result in zip(ixs, batch_results):
+                    fit_results[ix] = fit_result
+
         for ix in range(num_iters):
-            if self.verbose:
-                print('-- Running parameter set {} of {}...'.format(ix+1, num_iters),
-                      end='')
-            params = {k: v[ix] for k, v in self.params_map.items()}
-            losses, y_preds, __ = self.torch_model(X_subtrain,
-                                                   X_tune,
-                                                   y_subtrain,
-                                                   y_tune,
-                                                   params)
+            if batch_models:
+                losses, y_preds, __ = fit_results[ix]
+            else:
+                if self.verbose:
+                    print('-- Running parameter set {} of {}...'.format(ix+1, num_iters),
+                          end='')
+                losses, y_preds, __ = self._fit_eval(tensors, param_sets[ix])
             y_pred_subtrain, y_pred_tune = y_preds
             subtrain_loss, tune_loss = losses
             subtrain_auroc = roc_auc_score(y_subtrain, y_pred_subtrain, average="weighted")
@@ -433,18 +978,17 @@ class TorchLR:
             if self.verbose:
                 print('subtrain_loss: {:.4f}, tune_loss: {:.4f}'.format(
                         subtrain_loss, tune_loss))
-            result['param_set'].append(ix)
-            result['train/tune'].append('train')
-            result['loss'].append(subtrain_loss)
-            result['auroc'].append(subtrain_auroc)
-            for param in self.params_map.keys():
-                result[param].append(self.params_map[param][ix])
-            result['param_set'].append(ix)
-            result['train/tune'].append('tune')
-            result['loss'].append(tune_loss)
-            result['auroc'].append(tune_auroc)
-            for param in self.params_map.keys():
-                result[param].append(self.params_map[param][ix])
+            loss_col[2*ix], loss_col[2*ix+1] = subtrain_loss, tune_loss
+            auroc_col[2*ix], auroc_col[2*ix+1] = subtrain_auroc, tune_auroc
+
+        result = {
+            'param_set': np.repeat(np.arange(num_iters), 2),
+            'train/tune': np.tile(['train', 'tune'], num_iters),
+            'loss': loss_col,
+            'auroc': auroc_col
+        }
+        for param, values in self.params_map.items():
+            result[param] = np.repeat(values, 2)
         return pd.DataFrame(result)
 
 
@@ -515,14 +1059,8 @@ if __name__ == '__main__':
 
     y_pred_train, y_pred_test, y_pred_bn_train, y_pred_bn_test = y_pred
 
-    sk_train_acc = sum(
-            [1 for i in range(len(y_pred_train))
-               if y_pred_bn_train[i] == y_train[i]]
-    ) / len(y_pred_train)
-    sk_test_acc = sum(
-            [1 for i in range(len(y_pred_test))
-               if y_pred_bn_test[i] == y_test[i]]
-    ) / len(y_pred_test)
+    sk_train_acc = TorchLR.calculate_accuracy(y_train, y_pred_bn_train.flatten())
+    sk_test_acc = TorchLR.calculate_accuracy(y_test, y_pred_bn_test.flatten())
 
     sk_train_results = get_threshold_metrics(y_train, y_pred_train)
     sk_test_results = get_threshold_metrics(y_test, y_pred_test)